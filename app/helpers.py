@@ -3,10 +3,9 @@ import re
 
 from itertools import product
 
-from bids.layout import BIDSLayout
 
-
-def read_bids_dataset(bids_input, subject_list=None, session_list=None, collect_on_subject=False):
+def read_bids_dataset(bids_input, subject_list=None, session_list=None,
+                      collect_on_subject=False, database_file=None):
     """
     extracts and organizes relevant metadata from a bids dataset necessary
     for the dcan-modified hcp fmri processing pipeline.
@@ -15,6 +14,8 @@ def read_bids_dataset(bids_input, subject_list=None, session_list=None, collect_
     :param session_list: a list of session ids to filter on.
     :param collect_on_subject: collapses all sessions, for cases with
     non-longitudinal data spread across scan sessions.
+    :param database_file: optional path to an index of the whole dataset,
+    see get_layout.
     :return: bids data struct (nested dict)
     spec:
     {
@@ -35,7 +36,8 @@ def read_bids_dataset(bids_input, subject_list=None, session_list=None, collect_
     }
     """
 
-    layout = BIDSLayout(bids_input, index_metadata=True)
+    layout = get_layout(bids_input, subject_list=subject_list,
+                        database_file=database_file)
     subjects = layout.get_subjects()
 
     # filter subject list
@@ -83,6 +85,42 @@ def read_bids_dataset(bids_input, subject_list=None, session_list=None, collect_
         yield bids_data
 
 
+def get_layout(bids_input, subject_list=None, database_file=None):
+    """
+    indexes a bids dataset.
+    :param bids_input: path to input bids folder
+    :param subject_list: subject ids to index, other subject folders are
+    skipped.  Not used with a database_file, which indexes all subjects.
+    :param database_file: optional path to a sqlite index of the dataset,
+    reused if it exists, else created.  Must be deleted when the dataset
+    changes.
+    :return: BIDSLayout
+    """
+    # pybids pulls in pandas and sqlalchemy, so it is imported only when a
+    # dataset is indexed rather than for --help or --emit-sbatch.
+    from bids.layout import BIDSLayout
+
+    if database_file is None:
+        ignore = None
+        if subject_list:
+            root = re.escape(os.path.abspath(bids_input))
+            labels = '|'.join(re.escape(s) for s in subject_list)
+            ignore = re.compile(r'^%s/sub-(?!(%s)(/|$))' % (root, labels))
+        return BIDSLayout(bids_input, index_metadata=True, ignore=ignore)
+
+    database_file = os.path.abspath(database_file)
+    if os.path.exists(database_file):
+        return BIDSLayout(bids_input, index_metadata=True,
+                          database_file=database_file)
+    layout = BIDSLayout(bids_input, index_metadata=True)
+    # save to a temporary file first, so that concurrent runs never open a
+    # partial index.
+    tmp_file = '%s.%s.tmp' % (database_file, os.getpid())
+    layout.save(tmp_file, replace_connection=False)
+    os.replace(tmp_file, database_file)
+    return layout
+
+
 def set_anatomicals(layout, subject, sessions):
     """
     Returns dictionary of anatomical (T1w, T2w) filepaths and associated
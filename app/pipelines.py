@@ -1,13 +1,94 @@
+import atexit
 import inspect
 import json
-import multiprocessing as mp
+import logging
 import subprocess
+import sys
+import traceback
 
 import os
+from collections import ChainMap, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from string import Formatter
 
 from helpers import (get_fmriname, get_readoutdir, get_realdwelltime,
                      get_relpath, get_taskname, ijk_to_xyz, get_TR)
 
+# progress messages go through this logger so that concurrent sessions can
+# hand their records to a single listener in the parent process.
+_log = logging.getLogger('dcan')
+
+
+def _load_json(path):
+    """
+    reads a json file.
+    :param path: path to json file.
+    :return: decoded contents
+    """
+    with open(path, 'r') as fd:
+        return json.load(fd)
+
+
+def _dump_json(path, contents):
+    """
+    writes contents to a json file.
+    :param path: path to json file.
+    :param contents: json serializable object.
+    :return: None
+    """
+    with open(path, 'w') as fd:
+        json.dump(contents, fd, indent=4)
+
+
+# expected outputs for every stage, keyed by class name.
+_EXPECTED_OUTPUTS = _load_json(os.path.join(
+    os.path.dirname(os.path.realpath(__file__)),
+    'pipeline_expected_outputs.json'))
+
+# parses stage specs, see Stage._render.
+_formatter = Formatter()
+
+# subprocess environments, keyed by numbers of threads.  See _get_env.
+_ENV_CACHE = {}
+
+# environment variables for the number of OpenMP and BLAS threads.
+# FS_OMP_NUM_THREADS is read by recon-all when -openmp is not given.
+_OMP_VARS = ('OMP_NUM_THREADS', 'FS_OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS',
+             'MKL_NUM_THREADS', 'NUMEXPR_NUM_THREADS')
+
+# worker pools shared by all stages, keyed by number of workers.
+_STAGE_POOLS = {}
+
+
+@atexit.register
+def _shutdown_stage_pools():
+    for pool in _STAGE_POOLS.values():
+        pool.shutdown()
+
+
+class _NoneAsNONE(object):
+    """
+    read-only view of a dict which gives None values as "NONE", so that specs
+    can be formatted with format_map without copying kwargs.
+    """
+
+    def __init__(self, mapping):
+        self.mapping = mapping
+
+    def __getitem__(self, key):
+        value = self.mapping[key]
+        return "NONE" if value is None else value
+
+
+class _ShellVars(object):
+    """
+    mapping which gives each key as a shell variable, so that scripts can be
+    formatted without reading the environment.
+    """
+
+    def __getitem__(self, key):
+        return '${%s}' % key
+
 
 class ParameterSettings(object):
     """
@@ -123,6 +204,8 @@ class ParameterSettings(object):
         :param bids_data: yielded spec from read_bids_dataset
         :param output_directory: output directory for pipeline
         """
+        # cache of _params, reset whenever a parameter is set.
+        self._params_cache = None
 
         # input bids data struct
         self.bids_data = bids_data
@@ -138,7 +221,7 @@ class ParameterSettings(object):
                 self.bids_data['t2w_metadata'])
         else:
             # The infant pipeline does not work without T2w...
-            print('\nERROR: The infant pipeline is not able to run without T2w data.\n')
+            _log.error('\nERROR: The infant pipeline is not able to run without T2w data.\n')
             raise Exception('The infant pipeline is not able to run without T2w data')
             # ...but if it ever does, do this.
             self.useT2 = 'false'
@@ -156,7 +239,11 @@ class ParameterSettings(object):
             # spin echo field map spacing @TODO read during volume per fmap?
             self.echospacing = self.bids_data['fmap_metadata']['positive'][0][
                 'EffectiveEchoSpacing']
-            self.echospacing = ('%.12f' % self.echospacing).rstrip('0')
+            echospacing = format(self.echospacing, '.12g')
+            if 'e' in echospacing:
+                # keep fixed point notation for the hcp scripts.
+                echospacing = ('%.12f' % self.echospacing).rstrip('0')
+            self.echospacing = echospacing
             # distortion correction phase encoding direction
             self.seunwarpdir = ijk_to_xyz(
                 self.bids_data['func_metadata'][0]['PhaseEncodingDirection'])
@@ -204,6 +291,18 @@ class ParameterSettings(object):
         # @TODO handle bids formatted physio data
         self.physio = None
 
+        # derived names and timing of each functional run, keyed by path.
+        self.func_index = {
+            fmri: {
+                'name': get_fmriname(fmri),
+                'task': get_taskname(fmri),
+                'relpath': get_relpath(fmri),
+                'TR': get_TR(meta),
+            }
+            for fmri, meta in zip(self.bids_data['func'],
+                                  self.bids_data['func_metadata'])
+        }
+
         # intermediate template defaults
         self.t1wstudytemplate = None
         self.t1wstudytemplatebrain = None
@@ -215,10 +314,10 @@ class ParameterSettings(object):
         self.session = self.bids_data['session']
 
         # @ input files @ #
-        session_root = '/'.join(self.t1w[0].split('/')[:-2])
+        session_root = os.path.dirname(os.path.dirname(self.t1w[0]))
         self.unproc = os.path.join(session_root, 'func')
 
-        bids_input_root = '/'.join(session_root.split('/')[:-2])
+        bids_input_root = os.path.dirname(os.path.dirname(session_root))
         self.sourcedata_root = os.path.join(bids_input_root,'sourcedata')
 
         # print command for HCP
@@ -236,27 +335,60 @@ class ParameterSettings(object):
         return self._params()[item]
 
     def __setitem__(self, key, value):
+        # parameters are set through here so that _params stays current.
+        self._params_cache = None
         setattr(self, key, value)
 
     def _params(self):
         """
-        gets all class parameters which do not start with an underscore.
+        gets all class parameters which do not start with an underscore.  The
+        result is cached until a parameter is set.
         :return: dictionary of class parameter names and values.
         """
-        params = inspect.getmembers(self, lambda a: not inspect.isroutine(a))
-        params = {x[0]: x[1] for x in params if not x[0].startswith('_')}
+        if self._params_cache is not None:
+            return self._params_cache
+        names = set(vars(self))
+        for cls in type(self).__mro__:
+            names.update(vars(cls))
+        params = {name: getattr(self, name) for name in names
+                  if not name.startswith('_')}
+        params = {k: v for k, v in params.items()
+                  if not inspect.isroutine(v)}
+        # class templates are still to be formatted otherwise.
+        if type(self).__dict__.get('_class_templates_formatted'):
+            self._params_cache = params
         return params
 
+    @classmethod
+    def _format_class_templates(cls):
+        """
+        formats class parameter strings to insert environment variables.  The
+        environment does not change, so this is done once per class.
+        :return: None
+        """
+        env = dict(os.environ)
+        for klass in cls.__mro__:
+            if klass is object or \
+                    klass.__dict__.get('_class_templates_formatted'):
+                continue
+            for item, value in list(vars(klass).items()):
+                if not item.startswith('_') and isinstance(value, str) \
+                        and '{' in value:
+                    setattr(klass, item, value.format_map(env))
+            klass._class_templates_formatted = True
+
     def _format(self):
         """
         formats all class parameter strings to insert environment variables.
         :return: None
         """
-        params = self._params()
-        # format all attributes
-        for item, value in params.items():
-            if isinstance(value, str):
-                setattr(self, item, value.format(**os.environ))
+        self._format_class_templates()
+        env = dict(os.environ)
+        # format instance attributes which contain a replacement field
+        for item, value in list(vars(self).items()):
+            if not item.startswith('_') and isinstance(value, str) \
+                    and '{' in value:
+                self[item] = value.format_map(env)
 
     def get_params(self):
         """
@@ -264,7 +396,8 @@ class ParameterSettings(object):
         :return: dictionary of instance variable names and values
         """
         self._format()
-        return self._params()
+        # stages modify their kwargs, so hand each one its own copy.
+        return dict(self._params())
 
     def get_bids(self, *args):
         """
@@ -281,24 +414,24 @@ class ParameterSettings(object):
     def set_anat_only(self, anat_only=False):
         if anat_only:
             # Assume there is no 'func' data...
-            self.unproc = None
+            self['unproc'] = None
             # and no output from dcan-bold-proc.
-            self.summary_dir = None
+            self['summary_dir'] = None
 
     def set_atropos_mask_method(self, value):
-        self.atropos_mask_method = value
+        self['atropos_mask_method'] = value
 
     def set_bandstop_filter(self, lower_bound, upper_bound,
                             filter_type='notch'):
-        self.motion_filter_type = filter_type
-        self.band_stop_min = lower_bound
-        self.band_stop_max = upper_bound
+        self['motion_filter_type'] = filter_type
+        self['band_stop_min'] = lower_bound
+        self['band_stop_max'] = upper_bound
 
     def set_hypernormalization_method(self, norm_method):
-        self.norm_method = norm_method
+        self['norm_method'] = norm_method
 
     def set_mc_frame(self, value):
-        self.mc_frame = value
+        self['mc_frame'] = value
 
     def set_templates(self, t1_study_template, t1_study_template_brain, t2_study_template,
             t2_study_template_brain, multi_template_dir, multi_masking_dir):
@@ -313,25 +446,25 @@ class ParameterSettings(object):
         :return: None
         """
         if t1_study_template:
-            self.t1wstudytemplate = t1_study_template
-            self.t1wstudytemplatebrain = t1_study_template_brain
+            self['t1wstudytemplate'] = t1_study_template
+            self['t1wstudytemplatebrain'] = t1_study_template_brain
 
         if t2_study_template:
-            self.t2wstudytemplate = t2_study_template
-            self.t2wstudytemplatebrain = t2_study_template_brain
+            self['t2wstudytemplate'] = t2_study_template
+            self['t2wstudytemplatebrain'] = t2_study_template_brain
 
         if multi_template_dir:
-            self.multitemplatedir = multi_template_dir
+            self['multitemplatedir'] = multi_template_dir
 
         if multi_masking_dir:
-            self.multimaskingdir = multi_masking_dir
+            self['multimaskingdir'] = multi_masking_dir
 
     def turn_off_cropping(self):
-        self.crop = False
+        self['crop'] = False
 
     def set_dcmethod(self, value):
         if value:
-            self.dcmethod = value
+            self['dcmethod'] = value
 
     def set_atropos_range(self, lower_bound, upper_bound):
         # Set the values to send to PreFreeSurfer.
@@ -342,35 +475,35 @@ class ParameterSettings(object):
     def set_max_cortical_thickness(self, value):
         # Set the value to send to FreeSurfer.
         if value:
-            self.max_cortical_thickness = value
+            self['max_cortical_thickness'] = value
         else:
-            self.max_cortical_thickness = 5  # FreeSurfer default is 5 mm.
+            self['max_cortical_thickness'] = 5  # FreeSurfer default is 5 mm.
 
 
     def set_jlf_method(self, value):
         if value and value is not None:
-            self.jlf_method = value
+            self['jlf_method'] = value
         else:
             # Default method:
-            self.jlf_method = "T1W"
+            self['jlf_method'] = "T1W"
 
     def set_smoothing_iterations(self, value):
         if value:
-            self.smoothing_iterations = value
+            self['smoothing_iterations'] = value
         else:
-            self.smoothing_iterations = 10 # FreeSurfer default.
+            self['smoothing_iterations'] = 10 # FreeSurfer default.
 
     def set_subcortical_map_method(self, value):
         if value and value is not None:
-            self.subcortical_map_method = value
+            self['subcortical_map_method'] = value
         else:
-            self.subcortical_map_method = "ROI_MAP"
+            self['subcortical_map_method'] = "ROI_MAP"
 
     def set_t1_brain_mask(self, value):
         # The brain mask is generated by PreFreeSurfer. This allows the user
         # to pass in a different brain mask to be used.
         if value:
-            self.t1_brain_mask = value
+            self['t1_brain_mask'] = value
 
 
     def set_aseg(self, value):
@@ -378,10 +511,10 @@ class ParameterSettings(object):
         # a different aseg to FreeSurfer, this allows that to happen.
         if value:
             # Set to the path provided.
-            self.aseg = value
+            self['aseg'] = value
         else:
             # Will make the correct path when FreeSurfer is initialized.
-            self.aseg = "DEFAULT"
+            self['aseg'] = "DEFAULT"
 
 
 class Status(object):
@@ -401,6 +534,8 @@ class Status(object):
         'incomplete': 2,
         'succeeded': 1,
     }
+    # states in which a node counts as having succeeded.
+    _success_states = frozenset((states['succeeded'], states['unchecked']))
 
     def __init__(self, folder_path):
         """
@@ -416,23 +551,22 @@ class Status(object):
             'comment': '',
             }
 
-        if not os.path.exists(self.file_path):
-            self._write_dict(**defaults)
+        if os.path.exists(self.file_path):
+            self._store = _load_json(self.file_path)
+        else:
+            self._store = defaults
+            self._write_dict(**self._store)
 
     def __getitem__(self, key):
-        with open(self.file_path, 'r') as fd:
-            return json.load(fd)[key]
+        return self._store[key]
 
     def __setitem__(self, key, value):
-        with open(self.file_path, 'r') as fd:
-            store = json.load(fd)
-        store[key] = value
-        self._write_dict(**store)
+        self._store[key] = value
+        self._write_dict(**self._store)
         return value
 
     def _write_dict(self, **contents):
-        with open(self.file_path, 'w') as fd:
-            json.dump(contents, fd, indent=4)
+        _dump_json(self.file_path, contents)
 
     def increment_run(self):
         self['num_runs'] += 1
@@ -455,8 +589,7 @@ class Status(object):
         self['comment'] = comment
 
     def succeeded(self):
-        return self['node_status'] in (Status.states['succeeded'],
-                                       Status.states['unchecked'])
+        return self._store['node_status'] in Status._success_states
 
 
 class Stage(object):
@@ -477,12 +610,23 @@ class Stage(object):
     optional overriding:
     cmdline:  will need overriding as generator to utilize concurrency.  See
     FMRIVolume.
+    is_concurrent: must be set True when cmdline is a generator.
     setup: executes prior to executable.  Recommended to wrap super().
     teardown: executes after executable completes.  Recommended to wrap super().
 
     run: not intended for override.
     """
 
+    # True for stages whose cmdline is a generator of concurrent commands.
+    is_concurrent = False
+    # True for single command stages whose outputs nothing else in the
+    # pipeline depends on, which may replace the process, see exec_replace.
+    is_terminal = False
+    # maximum number of OpenMP/BLAS and ITK threads of the script, out of
+    # the cores given to it.  None uses all of them.  See _thread_counts.
+    omp_threads = None
+    itk_threads = 2
+
     # runtime settings
     call_active = True
     check_expected_outputs_active = True
@@ -492,20 +636,50 @@ class Stage(object):
     def __init__(self, config):
         self.config = config
         self.kwargs = config.get_params()
+        # path to the main script, formatted with the environment once.
+        try:
+            self.resolved_script = self.script.format_map(os.environ)
+        except KeyError as e:
+            raise RuntimeError(
+                'environment variable %s must be set to run %s.'
+                % (e.args[0], self.__class__.__name__)) from None
+        # functional runs of the session and their names, shared by the
+        # stages which process each run.
+        self._funcs = list(config.get_bids('func'))
+        self._func_meta = list(config.get_bids('func_metadata'))
+        self._fmrinames = [config.func_index[f]['name'] for f in self._funcs]
+        self._log_dir = None
+        # cores given to run, see DCANBOLDProcessing.setup.
+        self._ncpus = 1
         self.status = Status(self._get_log_dir())
-        here = os.path.dirname(os.path.realpath(__file__))
-        with open(os.path.join(here, 'pipeline_expected_outputs.json')) as fd:
-            jso = json.load(fd)
-            self.expected_outputs_spec = jso[self.__class__.__name__]
+        self.expected_outputs_spec = _EXPECTED_OUTPUTS[self.__class__.__name__]
+        # formatted expected_outputs_spec, see get_expected_outputs.
+        self._expected_outputs = None
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        # parse the spec once per class, see _render.
+        if isinstance(getattr(cls, 'spec', None), str):
+            cls._spec_parts = tuple(tuple(_formatter.parse(field))
+                                    for field in cls.spec.split())
 
     def __str__(self):
-        cmdline = self.cmdline()
-        if inspect.isgenerator(cmdline):
+        return self.format_commands()
+
+    def format_commands(self, resolve_env=True):
+        """
+        formats the command lines of this stage for display.
+        :param resolve_env: show the script path as it is run, else with
+        environment variables left to the shell, see _render_all.
+        :return: command lines, one argument per line.
+        """
+        cmdlines = self._render_all(resolve_env)
+        if self.is_concurrent:
             string = ''
-            for cmd in cmdline:
-                string += ' \\\n    '.join(cmd.split()) + '\n'
+            for cmd in cmdlines:
+                string += ' \\\n    '.join(cmd) + '\n'
         else:
-            string = ' \\\n    '.join(cmdline.split())
+            string = ' \\\n    '.join(cmdlines[0])
         return string
 
     @classmethod
@@ -527,45 +701,84 @@ class Stage(object):
     def activate_ignore_expected_outputs(cls):
         cls.ignore_expected_outputs = True
 
+    @classmethod
+    def get_pool(cls, ncpus):
+        """
+        returns the worker pool shared by all stages for concurrent
+        execution, creating it on first use.  Workers only wait on
+        subprocesses, so threads are used rather than processes.
+        :param ncpus: number of workers.
+        :return: executor with ncpus workers.
+        """
+        if ncpus not in _STAGE_POOLS:
+            _STAGE_POOLS[ncpus] = ThreadPoolExecutor(max_workers=ncpus)
+        return _STAGE_POOLS[ncpus]
+
     def _get_log_dir(self):
         """
         returns the subject's log directory for this stage
         :return: path to log directory
         """
-        log_dir = os.path.join(self.kwargs['logs'], self.__class__.__name__)
-        if not os.path.isdir(log_dir):
-            os.makedirs(log_dir)
-        return log_dir
+        if self._log_dir is None:
+            self._log_dir = os.path.join(self.kwargs['logs'],
+                                         self.__class__.__name__)
+            os.makedirs(self._log_dir, exist_ok=True)
+        return self._log_dir
 
-    def check_expected_outputs(self):
+    def check_expected_outputs(self, found=None):
         """
         checks the existence of the expected outputs for this stage.
+        :param found: optional result of find_expected_outputs, if it was
+        already called.
         :return: True if all outputs exist, else False.
         """
         if not self.check_expected_outputs_active:
             return True
 
-        outputs = self.get_expected_outputs()
-        checklist = [os.path.exists(p) for p in outputs]
+        outputs, checklist = found or self.find_expected_outputs()
         if not all(checklist):
-            print('missing expected outputs from %s' %
-                  self.__class__.__name__)
+            _log.info('missing expected outputs from %s' %
+                      self.__class__.__name__)
             dne_list = [f for i, f in enumerate(outputs) if not checklist[i]]
             for f in dne_list:
-                print('file not found: %s' % f)
+                _log.info('file not found: %s' % f)
             if not self.ignore_expected_outputs:
                 return False
 
         return True
 
+    def find_expected_outputs(self, contents=None):
+        """
+        looks for the expected outputs of this stage.
+        :param contents: optional directory listings, see list_output_dirs.
+        :return: list of expected outputs and list of whether each exists.
+        """
+        outputs = self.get_expected_outputs()
+        return outputs, _find_existing(outputs, contents)
+
+    @staticmethod
+    def list_output_dirs(stages):
+        """
+        lists every directory holding expected outputs of the given stages
+        once, so that stages sharing directories need not list them again.
+        :param stages: list of stages.
+        :return: directory listings for find_expected_outputs.
+        """
+        return _list_dirs({os.path.dirname(p) for stage in stages
+                           for p in stage.get_expected_outputs()})
+
     def get_expected_outputs(self):
         """
         formats and returns expected outputs.  Must be overridden for
-        expected outputs of concurrent executions.
+        expected outputs of concurrent executions.  The formatted outputs are
+        kept, so stages must not modify self.kwargs after __init__; per run
+        values are rendered from a ChainMap over self.kwargs instead.
         :return: formatted list of expected outputs
         """
-        expected_outputs = [p.format(**self.kwargs)
-                            for p in self.expected_outputs_spec]
+        if self._expected_outputs is None:
+            self._expected_outputs = tuple(p.format_map(self.kwargs)
+                                           for p in self.expected_outputs_spec)
+        expected_outputs = list(self._expected_outputs)
         expected_outputs += self.get_conditional_expected_outputs()
         return expected_outputs
 
@@ -584,17 +797,20 @@ class Stage(object):
         removes expected outputs for this stage if they exist.
         :return: None
         """
-        if not self.remove_expected_outputs:
+        if not self.remove_expected_outputs_active:
             return
-        outputs = self.get_expected_outputs()
-        checklist = [os.path.isfile(p) for p in outputs]
-        if any(checklist):
-            print('found outputs from an earlier run of %s' %
-                  self.__class__.__name__)
-            rm_list = [f for i, f in enumerate(outputs) if checklist[i]]
-            for f in rm_list:
-                print('removing %s' % f)
+        found = False
+        for f in self.get_expected_outputs():
+            # let os.remove check for the file rather than checking first.
+            try:
                 os.remove(f)
+            except (FileNotFoundError, IsADirectoryError):
+                continue
+            if not found:
+                _log.info('found outputs from an earlier run of %s' %
+                          self.__class__.__name__)
+                found = True
+            _log.info('removing %s' % f)
 
     def identify_templates(self):
         """
@@ -603,14 +819,14 @@ class Stage(object):
         """
         # Identify which templates will be used.
         if os.path.isfile(self.config.templatesidentifier):
-            print("Templates information follows:")
+            _log.info("Templates information follows:")
             with open(self.config.templatesidentifier) as rm:
                 rmcontent =  rm.readlines()
                 for rmline in rmcontent:
-                    print("\t%s" % rmline.strip(), flush=True)
+                    _log.info("\t%s" % rmline.strip())
                 rm.close()
         else:
-            print("There is no available information about the templates being used.", flush=True)
+            _log.info("There is no available information about the templates being used.")
 
 
     def setup(self):
@@ -646,12 +862,25 @@ class Stage(object):
             raise Exception('error caught during stage: %s' %
                             self.__class__.__name__)
 
+    def _render(self, kwargs):
+        """
+        formats the spec of this stage into a list of command line arguments,
+        one per whitespace separated field of the spec.  Formatted values may
+        contain spaces.
+        :param kwargs: mapping of values for the replacement fields of spec.
+        :return: list of command line arguments.
+        """
+        return [''.join(literal + (format(kwargs[key], format_spec)
+                                   if key is not None else '')
+                        for literal, key, format_spec, _ in field)
+                for field in self._spec_parts]
+
     @property
     def args(self):
         """
-        Formats the command line argument "spec", returning the full string of
+        Formats the command line argument "spec", returning the full list of
         inputs to the main script.  Must be overridden.
-        :return: string of space separated command line arguments.
+        :return: list of command line arguments.
         """
         raise NotImplementedError
 
@@ -665,53 +894,116 @@ class Stage(object):
 
     def cmdline(self):
         """
-        returns the formatted string for the command to be called.  Must
+        returns the formatted argv for the command to be called.  Must
         be overridden as a generator object for concurrent execution.
-        :return: command line string.
+        :return: command line argument list.
         """
-        script = self.script.format(**os.environ)
-        return ' '.join((script, self.args))
+        return [self.resolved_script] + self.args
 
-    def run(self, ncpus=1):
+    def _render_all(self, resolve_env=True):
+        """
+        formats the command lines of this stage.
+        :param resolve_env: insert environment variables into the script
+        path, else leave them as shell variables, e.g. ${HCPPIPEDIR}.
+        :return: list of command line argument lists, one per command.
+        """
+        if resolve_env:
+            script = self.resolved_script
+        else:
+            script = self.script.format_map(_ShellVars())
+        if self.is_concurrent:
+            return [[script] + args for args in self.args]
+        return [[script] + self.args]
+
+    def run(self, ncpus=1, terminal=False):
         """
         runs this stage
         :param ncpus: number of available cores for concurrent execution or
         for multithreaded computation.
+        :param terminal: nothing runs after this stage, so a terminal stage
+        may replace the process with its script.  See exec_replace.
         :return: None
         """
+        self._ncpus = ncpus
         self.identify_templates()
         self.setup()
         # a generator cmdline supports parallel execution
-        if inspect.isgeneratorfunction(self.cmdline):
+        if self.is_concurrent:
             cmdlist = []
-            for cmd in self.cmdline():
+            for cmd, fmriname in zip(self.cmdline(), self._fmrinames):
                 log_dir = self._get_log_dir()
-                out_log = os.path.join(log_dir,
-                                       self.kwargs['fmriname'] + '.out')
-                err_log = os.path.join(log_dir,
-                                       self.kwargs['fmriname'] + '.err')
+                out_log = os.path.join(log_dir, fmriname + '.out')
+                err_log = os.path.join(log_dir, fmriname + '.err')
                 cmdlist.append((cmd, out_log, err_log))
-            # This path is used when we are in stages that make a thread for
-            # each task. Cap the number of processes as we keep running out of
-            # memory when we have too many tasks - KJS 20200303
-            if ncpus > 6:
-                ncpus=6
-            with mp.Pool(processes=ncpus) as pool:
-                result = pool.starmap(self.call, cmdlist)
+            result = self.run_parallel(cmdlist, ncpus)
         else:
             cmd = self.cmdline()
             log_dir = self._get_log_dir()
             out_log = os.path.join(log_dir, self.__class__.__name__ + '.out')
             err_log = os.path.join(log_dir, self.__class__.__name__ + '.err')
+            if terminal and self.is_terminal and self.call_active:
+                self.exec_replace(cmd, out_log, err_log, num_threads=ncpus)
             result = self.call(cmd, out_log, err_log, num_threads=ncpus)
         self.teardown(result)
 
-    def call(self, *args, **kwargs):
+    def exec_replace(self, cmd, out_log, err_log, num_threads=1):
+        """
+        replaces this process with the command, so that no python parent is
+        kept in memory while it runs.  Does not return, thus teardown does
+        not run: the exit status of the process is that of the command, and
+        the stage status is left as running.
+        :param cmd: command line argument list.
+        :param out_log: path to stdout log.
+        :param err_log: path to stderr log.
+        :param num_threads: number of threads for the command.
+        """
+        env = _get_env(*self._thread_counts(num_threads))
+        sys.stdout.flush()
+        sys.stderr.flush()
+        with open(out_log, 'w') as out, open(err_log, 'w') as err:
+            os.dup2(out.fileno(), 1)
+            os.dup2(err.fileno(), 2)
+        os.execvpe(cmd[0], cmd, env)
+
+    def run_parallel(self, cmdlist, ncpus=1):
+        """
+        runs independent commands concurrently, dividing the available cores
+        between them.
+        :param cmdlist: list of (cmd, out_log, err_log) tuples.
+        :param ncpus: number of available cores.
+        :return: list of exit statuses, parallel to cmdlist.
+        """
+        # This path is used when we are in stages that make a thread for
+        # each task. Cap the number of processes as we keep running out of
+        # memory when we have too many tasks - KJS 20200303
+        workers = max(1, min(ncpus, 6, len(cmdlist)))
+        # cores left over by the cap are used for threading within each task.
+        num_threads = max(1, ncpus // workers)
+        pool = self.get_pool(workers)
+        return list(pool.map(
+            lambda c: self.call(*c, num_threads=num_threads), cmdlist))
+
+    def _thread_counts(self, num_threads):
+        """
+        divides cores between the threading libraries used by the script.
+        A single core leaves the libraries at their own defaults.
+        :param num_threads: number of cores for the script.
+        :return: number of OpenMP threads and number of ITK threads, None to
+        leave them unset.
+        """
+        if num_threads <= 1:
+            return None, None
+        return tuple(num_threads if limit is None else min(limit, num_threads)
+                     for limit in (self.omp_threads, self.itk_threads))
+
+    def call(self, cmd, out_log, err_log, num_threads=1):
         """
         runs command if call is active.
+        :param num_threads: number of cores for the command.
         """
         if self.call_active:
-            return _call(*args, **kwargs)
+            return _call(cmd, out_log, err_log,
+                         *self._thread_counts(num_threads))
         else:
             return 0  # "success"
 
@@ -762,13 +1054,13 @@ class PreFreeSurfer(Stage):
            ' --jlfmethod={jlf_method}' \
            ' --t1brainmask={t1_brain_mask}' \
            ' --crop={crop}'
-
-
     def __init__(self, config):
         super(__class__, self).__init__(config)
         # modify t1/t2 inputs for spec
-        self.kwargs['t1'] = '@'.join(self.kwargs.get('t1w'))
-        self.kwargs['t2'] = '@'.join(self.kwargs.get('t2w', []))
+        t1s = self.kwargs.get('t1w') or []
+        t2s = self.kwargs.get('t2w') or []
+        self.kwargs['t1'] = t1s[0] if len(t1s) == 1 else '@'.join(t1s)
+        self.kwargs['t2'] = t2s[0] if len(t2s) == 1 else '@'.join(t2s)
         if self.kwargs['dcmethod'] == 'TOPUP':
             self.kwargs['sephasepos'], self.kwargs['sephaseneg'] = \
                 self._get_intended_sefmaps()
@@ -776,6 +1068,8 @@ class PreFreeSurfer(Stage):
             self.kwargs['sephasepos'] = None
             self.kwargs['sephaseneg'] = None
         self.kwargs['normalization'] = 'true'
+        # formatted args, see args.
+        self._args_cache = None
 
     def _get_intended_sefmaps(self):
         """
@@ -790,14 +1084,14 @@ class PreFreeSurfer(Stage):
             for idx, sefm in enumerate(self.config.get_bids('fmap_metadata',
                                                         direction)):
                 intended_targets = sefm.get('IntendedFor', [])
-                if 'T1w' in ' '.join(intended_targets):
+                if any('T1w' in t for t in intended_targets):
                     intended_idx[direction] = idx
                     break
             else:
                 if idx != 0:
-                    print('WARNING: the intended %s spin echo for anatomical '
-                          'distortion correction is not explicitly defined in '
-                          'the sidecar json.' % direction)
+                    _log.warning('WARNING: the intended %s spin echo for anatomical '
+                                 'distortion correction is not explicitly '
+                                 'defined in the sidecar json.' % direction)
                 intended_idx[direction] = 0
 
         return self.config.get_bids('fmap', 'positive', intended_idx[
@@ -806,10 +1100,10 @@ class PreFreeSurfer(Stage):
 
     @property
     def args(self):
-        # None to NONE
-        kw = {k: (v if v is not None else "NONE")
-              for k, v in self.kwargs.items()}
-        return self.spec.format(**kw)
+        if self._args_cache is None:
+            # None to NONE
+            self._args_cache = self._render(_NoneAsNONE(self.kwargs))
+        return list(self._args_cache)
 
 
 class FreeSurfer(Stage):
@@ -817,6 +1111,8 @@ class FreeSurfer(Stage):
 # For infants we run FNL_FreeInfantPipeline.sh (not FreeSurferPipeline.sh).
     script = '{HCPPIPEDIR}/FreeSurfer/FNL_FreeInfantPipeline.sh'
 
+    itk_threads = 1
+
     spec = ' --subject={subject}' \
            ' --subjectDIR={t1w_path}' \
            ' --t1={t1_restore}' \
@@ -835,28 +1131,22 @@ class FreeSurfer(Stage):
     def __init__(self, config):
         super(__class__, self).__init__(config)
         # Note: 'subjectDIR' in script is actually path to T1w (files produced by PreFreeSurfer).
-        self.kwargs['t1w_path'] = os.path.join(
-            self.kwargs['path'], 'T1w')
-        self.kwargs['t1_restore'] = os.path.join(
-            self.kwargs['t1w_path'], 'T1w_acpc_dc_restore.nii.gz')
-        self.kwargs['t1_restore_brain'] = os.path.join(
-            self.kwargs['t1w_path'], 'T1w_acpc_dc_restore_brain.nii.gz')
-        self.kwargs['t2_restore'] = os.path.join(
-            self.kwargs['t1w_path'], 'T2w_acpc_dc_restore.nii.gz')
+        p = os.path.join(self.kwargs['path'], 'T1w')
+        self.kwargs['t1w_path'] = p
+        self.kwargs['t1_restore'] = f'{p}/T1w_acpc_dc_restore.nii.gz'
+        self.kwargs['t1_restore_brain'] = f'{p}/T1w_acpc_dc_restore_brain.nii.gz'
+        self.kwargs['t2_restore'] = f'{p}/T2w_acpc_dc_restore.nii.gz'
         # Additional files needed by infants pipeline:
-        if config.aseg is "DEFAULT":
-            self.kwargs['aseg'] = os.path.join(
-                    self.kwargs['t1w_path'], 'aseg_acpc.nii.gz')
+        if config.aseg == "DEFAULT":
+            self.kwargs['aseg'] = f'{p}/aseg_acpc.nii.gz'
         else:
             self.kwargs['aseg'] = os.path.abspath(config.aseg)
-        self.kwargs['t1n_image'] = os.path.join(
-            self.kwargs['t1w_path'], 'T1wN_acpc.nii.gz')
-        self.kwargs['t1n_brain'] = os.path.join(
-            self.kwargs['t1w_path'], 'T1wN_acpc_brain.nii.gz')
+        self.kwargs['t1n_image'] = f'{p}/T1wN_acpc.nii.gz'
+        self.kwargs['t1n_brain'] = f'{p}/T1wN_acpc_brain.nii.gz'
 
     @property
     def args(self):
-        return self.spec.format(**self.kwargs)
+        return self._render(self.kwargs)
 
 
 class PostFreeSurfer(Stage):
@@ -882,13 +1172,17 @@ class PostFreeSurfer(Stage):
 
     @property
     def args(self):
-        return self.spec.format(**self.kwargs)
+        return self._render(self.kwargs)
 
 
 class FMRIVolume(Stage):
 
     script = '{HCPPIPEDIR}/fMRIVolume/GenericfMRIVolumeProcessingPipeline.sh'
 
+    is_concurrent = True
+    # registration with ANTs scales with threads.
+    itk_threads = None
+
     spec = ' --path={path}' \
            ' --fmriname={fmriname}' \
            ' --fmritcs={fmritcs}' \
@@ -913,33 +1207,38 @@ class FMRIVolume(Stage):
 
     def __init__(self, config):
         super(__class__, self).__init__(config)
+        # spin echo metadata, searched for each run.
+        if self.kwargs['dcmethod'] == 'TOPUP':
+            self._sefm_metadata = {
+                direction: list(config.get_bids('fmap_metadata', direction))
+                for direction in ['positive', 'negative']
+            }
 
-    def __str__(self):
-        string = ''
-        for cmd in self.cmdline():
-            string += ' \\\n    '.join(cmd.split()) + '\n'
-        return string
-
-    def _get_intended_sefmaps(self):
+    def _get_intended_sefmaps(self, fmritcs):
         """
         search for IntendedFor field from sidecar json to determine
         appropriate field map pair, else give the first spin echo pair.
+        :param fmritcs: path to the functional run.
         :return: pair of spin echo filenames, positive then negative
         """
+        target = self.config.func_index[fmritcs]['relpath']
         intended_idx = {}
         for direction in ['positive', 'negative']:
-            for idx, sefm in enumerate(self.config.get_bids('fmap_metadata',
-                                                            direction)):
+            for idx, sefm in enumerate(self._sefm_metadata[direction]):
                 intended_targets = sefm.get('IntendedFor', [])
-                if get_relpath(self.kwargs['fmritcs']) in ' '.join(
-                        intended_targets):
+                if isinstance(intended_targets, str):
+                    intended_targets = [intended_targets]
+                # match whole targets, not substrings of other runs' paths.
+                targets = [_intended_relpath(t) for t in intended_targets]
+                if any(t == target or fmritcs.endswith('/' + t)
+                       for t in targets):
                     intended_idx[direction] = idx
                     break
             else:
                 if idx != 0:
-                    print('WARNING: the intended %s spin echo for anatomical '
-                          'distortion correction is not explicitly defined in '
-                          'the sidecar json.' % direction)
+                    _log.warning('WARNING: the intended %s spin echo for anatomical '
+                                 'distortion correction is not explicitly '
+                                 'defined in the sidecar json.' % direction)
                 intended_idx[direction] = 0
 
         return self.config.get_bids('fmap', 'positive', intended_idx[
@@ -949,34 +1248,35 @@ class FMRIVolume(Stage):
 
     @property
     def args(self):
-        for fmri, meta in zip(self.config.get_bids('func'),
-                              self.config.get_bids('func_metadata')):
-            # set ts parameters
-            self.kwargs['fmritcs'] = fmri
-            self.kwargs['fmriname'] = get_fmriname(fmri)
-            self.kwargs['fmriscout'] = None  # not implemented
+        for fmri, meta, fmriname in zip(self._funcs, self._func_meta,
+                                        self._fmrinames):
+            # set ts parameters over kwargs, leaving kwargs unmodified.
+            run_kwargs = {
+                'fmritcs': fmri,
+                'fmriname': fmriname,
+                'fmriscout': None,  # not implemented
+            }
             if self.kwargs['dcmethod'] == 'TOPUP':
-                self.kwargs['seunwarpdir'] = ijk_to_xyz(
+                run_kwargs['seunwarpdir'] = ijk_to_xyz(
                         meta['PhaseEncodingDirection'])
-                self.kwargs['sephasepos'], self.kwargs['sephaseneg'] = \
-                    self._get_intended_sefmaps()
+                run_kwargs['sephasepos'], run_kwargs['sephaseneg'] = \
+                    self._get_intended_sefmaps(fmri)
             else:
-                self.kwargs['sephasepos'] = self.kwargs['sephaseneg'] = None
+                run_kwargs['sephasepos'] = run_kwargs['sephaseneg'] = None
             # None to NONE
-            kw = {k: (v if v is not None else "NONE")
-                  for k, v in self.kwargs.items()}
-            yield self.spec.format(**kw)
+            yield self._render(_NoneAsNONE(ChainMap(run_kwargs, self.kwargs)))
 
     def cmdline(self):
-        script = self.script.format(**os.environ)
         for argset in self.args:
-            yield ' '.join((script, argset))
+            yield [self.resolved_script] + argset
 
 
 class FMRISurface(Stage):
 
     script = '{HCPPIPEDIR}/fMRISurface/GenericfMRISurfaceProcessingPipeline.sh'
 
+    is_concurrent = True
+
     spec = ' --path={path}' \
            ' --subject={subject}' \
            ' --fmriname={fmriname}' \
@@ -991,30 +1291,26 @@ class FMRISurface(Stage):
     def __init__(self, config):
         super(__class__, self).__init__(config)
 
-    def __str__(self):
-        string = ''
-        for cmd in self.cmdline():
-            string += ' \\\n    '.join(cmd.split()) + '\n'
-        return string
-
     @property
     def args(self):
-        for fmri, meta in zip(self.config.get_bids('func'),
-                              self.config.get_bids('func_metadata')):
-            self.kwargs['fmriname'] = get_fmriname(fmri)
-            self.kwargs['TR'] = get_TR(meta)
-            yield self.spec.format(**self.kwargs)
+        for fmri, fmriname in zip(self._funcs, self._fmrinames):
+            run_kwargs = {
+                'fmriname': fmriname,
+                'TR': self.config.func_index[fmri]['TR'],
+            }
+            yield self._render(ChainMap(run_kwargs, self.kwargs))
 
     def cmdline(self):
-        script = self.script.format(**os.environ)
         for argset in self.args:
-            yield ' '.join((script, argset))
+            yield [self.resolved_script] + argset
 
 
 class DCANBOLDProcessing(Stage):
 
     script = '{DCANBOLDPROCDIR}/dcan_bold_proc.py'
 
+    is_concurrent = True
+
     spec = ' --subject={subject}' \
            ' --output-folder={path}' \
            ' --task={fmriname}' \
@@ -1032,23 +1328,45 @@ class DCANBOLDProcessing(Stage):
            ' --skip-seconds={skip_seconds}' \
            ' --contiguous-frames={contiguous_frames}'
 
+    # run setup and teardown inside this interpreter, see _call_in_process.
+    in_process_active = False
+
     def __init__(self, config):
         super(__class__, self).__init__(config)
 
+    @classmethod
+    def activate_in_process(cls):
+        cls.in_process_active = True
+
+    def call_in_process(self, cmd, out_log, err_log, num_threads=1):
+        """
+        runs dcan_bold_proc.py inside this interpreter if in process calls
+        are active, so that numpy and friends are imported once for both
+        setup and teardown.  Falls back to a subprocess if the script cannot
+        be loaded, including when it fails to import a package in this
+        interpreter.
+        :param num_threads: number of cores for the command.
+        """
+        if self.call_active and self.in_process_active:
+            result = _call_in_process(cmd, out_log, err_log,
+                                      *self._thread_counts(num_threads))
+            if result is not None:
+                return result
+        return self.call(cmd, out_log, err_log, num_threads=num_threads)
+
     def setup(self):
         """
         make ventricle and white matter masks.
         :return:
         """
         super(__class__, self).setup()
-        script = self.script.format(**os.environ)
-        args = self.spec.format(**self.kwargs)
-        cmd = ' '.join((script, args))
-        cmd += ' --setup'
+        args = self._render(self._session_kwargs())
+        cmd = [self.resolved_script] + args + ['--setup']
         log_dir = self._get_log_dir()
         out_log = os.path.join(log_dir, self.__class__.__name__ + '_setup.out')
         err_log = os.path.join(log_dir, self.__class__.__name__ + '_setup.err')
-        result = self.call(cmd, out_log, err_log)
+        result = self.call_in_process(cmd, out_log, err_log,
+                                      num_threads=self._ncpus)
 
     def teardown(self, result=0):
         """
@@ -1056,42 +1374,50 @@ class DCANBOLDProcessing(Stage):
         :param result:
         :return:
         """
-        fmris = [get_fmriname(fmri) for fmri in self.config.get_bids('func')]
-        fmrisets = list(set([get_taskname(fmri)
-                              for fmri in self.config.get_bids('func')]))
+        # group runs by task in one pass.
+        fmrisets = defaultdict(list)
+        for fmri, fmriname in zip(self._funcs, self._fmrinames):
+            fmrisets[self.config.func_index[fmri]['task']].append(fmriname)
 
-        script = self.script.format(**os.environ)
-        args = self.spec.format(**self.kwargs)
-        cmd = ' '.join((script, args))
-        cmd += ' --teardown'
+        args = self._render(self._session_kwargs())
+        cmd = [self.resolved_script] + args + ['--teardown']
 
-        for fmriset in fmrisets:
-            fmrilist = sorted([ fmri for fmri in fmris if fmriset in fmri ])
-            cmd += ' --tasklist ' + ','.join(fmrilist)
+        for fmrilist in fmrisets.values():
+            fmrilist.sort()
+            cmd += ['--tasklist', ','.join(fmrilist)]
 
         log_dir = self._get_log_dir()
         out_log = os.path.join(log_dir, self.__class__.__name__ + '_teardown.out')
         err_log = os.path.join(log_dir, self.__class__.__name__ + '_teardown.err')
-        result = self.call(cmd, out_log, err_log)
+        result = self.call_in_process(cmd, out_log, err_log,
+                                      num_threads=self._ncpus)
 
         super(__class__, self).teardown(result)
 
+    def _session_kwargs(self):
+        """
+        setup and teardown cover all runs, but the spec still requires a
+        task, so they are given the last run.
+        :return: kwargs for setup and teardown.
+        """
+        return ChainMap({'fmriname': self._fmrinames[-1]}, self.kwargs)
+
     @property
     def args(self):
-        for fmri in self.config.get_bids('func'):
-            self.kwargs['fmriname'] = get_fmriname(fmri)
-            yield self.spec.format(**self.kwargs)
+        for fmriname in self._fmrinames:
+            yield self._render(ChainMap({'fmriname': fmriname}, self.kwargs))
 
     def cmdline(self):
-        script = self.script.format(**os.environ)
         for argset in self.args:
-            yield ' '.join((script, argset))
+            yield [self.resolved_script] + argset
 
 
 class ExecutiveSummary(Stage):
 
     script = '{EXECSUMDIR}/ExecutiveSummary.py'
 
+    is_terminal = True
+
     spec = ' --bids-input={unproc}' \
            ' --output-dir={path}' \
            ' --participant-label={subject}' \
@@ -1105,15 +1431,15 @@ class ExecutiveSummary(Stage):
     @property
     def args(self):
         # None to NONE
-        kw = {k: (v if v is not None else "NONE")
-              for k, v in self.kwargs.items()}
-        return self.spec.format(**kw)
+        return self._render(_NoneAsNONE(self.kwargs))
 
 
 class CustomClean(Stage):
 
     script = '{CUSTOMCLEANDIR}/cleaning_script.py'
 
+    is_terminal = True
+
     spec = ' --dir={path}' \
            ' --json={input_json}'
 
@@ -1123,13 +1449,15 @@ class CustomClean(Stage):
 
     @property
     def args(self):
-        return self.spec.format(**self.kwargs)
+        return self._render(self.kwargs)
 
 
 class FileMapper(Stage):
 
     script = '{FILEMAPPERDIR}/BIDS_filemapper_wrapper.sh'
 
+    is_terminal = True
+
     spec = '{subject} ' \
            '{session} ' \
            '{path} ' \
@@ -1141,21 +1469,176 @@ class FileMapper(Stage):
 
     @property
     def args(self):
-        return self.spec.format(**self.kwargs)
+        return self._render(self.kwargs)
+
 
+def _intended_relpath(target):
+    """
+    normalizes an IntendedFor entry to a path relative to the subject folder.
+    :param target: IntendedFor entry, either relative to the subject folder
+    or a bids uri such as "bids::sub-01/ses-A/func/...".
+    :return: path relative to the subject folder, see helpers.get_relpath.
+    """
+    if target.startswith('bids::'):
+        target = target[len('bids::'):]
+    subject_dir, _, relpath = target.partition('/')
+    if subject_dir.startswith('sub-') and relpath:
+        target = relpath
+    return target
+
+
+def _list_dir(directory):
+    """
+    lists the entries of a directory.
+    :param directory: path to directory.
+    :return: set of entry names, empty if the directory cannot be read.
+    """
+    try:
+        with os.scandir(directory) as entries:
+            return {e.name for e in entries}
+    except OSError:
+        return set()
+
+
+def _list_dirs(dirs):
+    """
+    lists the entries of many directories.
+    :param dirs: collection of paths to directories.
+    :return: dict of directory path to set of entry names.
+    """
+    dirs = list(dirs)
+    if len(dirs) > 1:
+        # listing is io bound, so overlap the (possibly networked) reads.
+        with ThreadPoolExecutor(max_workers=min(8, len(dirs))) as executor:
+            return dict(zip(dirs, executor.map(_list_dir, dirs)))
+    return {d: _list_dir(d) for d in dirs}
+
+
+def _find_existing(paths, contents=None):
+    """
+    checks the existence of many paths, listing each parent directory once
+    rather than calling stat for every path.
+    :param paths: list of paths to check.
+    :param contents: optional listings of some of the parent directories.
+    :return: list of booleans, parallel to paths.
+    """
+    contents = dict(contents or {})
+    contents.update(_list_dirs(
+        {os.path.dirname(p) for p in paths}.difference(contents)))
+    return [os.path.basename(p) in contents[os.path.dirname(p)]
+            for p in paths]
 
-def _call(cmd, out_log, err_log, num_threads=1):
-    env = os.environ.copy()
-    if num_threads > 1:
-        # set parallel environment variables
-        env['OMP_NUM_THREADS'] = str(num_threads)
-        env['ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS'] = str(2) # str(num_threads)
-        if num_threads != 1:
-            print('Keep ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS at 1 instead of %s.' % num_threads)
+
+def _thread_vars(omp_threads=None, itk_threads=None):
+    """
+    returns the environment variables setting the given numbers of threads.
+    :param omp_threads: number of OpenMP and BLAS threads, None to leave
+    unset.
+    :param itk_threads: number of ITK threads, None to leave unset.
+    :return: dict of environment variables.
+    """
+    thread_vars = {}
+    if omp_threads is not None:
+        thread_vars.update((var, str(omp_threads)) for var in _OMP_VARS)
+    if itk_threads is not None:
+        thread_vars['ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS'] = str(itk_threads)
+    return thread_vars
+
+
+def _get_env(omp_threads=None, itk_threads=None):
+    """
+    returns the environment for subprocesses using the given numbers of
+    threads.  Environments are copied from os.environ once per pair of
+    thread counts and then reused.
+    :param omp_threads: number of OpenMP and BLAS threads, see _thread_vars.
+    :param itk_threads: number of ITK threads, see _thread_vars.
+    :return: environment dict, which must not be modified.
+    """
+    key = (omp_threads, itk_threads)
+    env = _ENV_CACHE.get(key)
+    if env is None:
+        env = os.environ.copy()
+        env.update(_thread_vars(omp_threads, itk_threads))
+        _ENV_CACHE[key] = env
+    return env
+
+
+def _call(cmd, out_log, err_log, omp_threads=None, itk_threads=None):
+    env = _get_env(omp_threads, itk_threads)
     with open(out_log, 'w') as out, open(err_log, 'w') as err:
-        result = subprocess.call(cmd.split(), stdout=out, stderr=err, env=env)
+        process = subprocess.Popen(cmd, stdout=out, stderr=err, env=env)
+        result = process.wait()
         if type(result) is list:
             if all(v == 0 for v in result):
                 result = 0
     return result
 
+
+def _call_in_process(cmd, out_log, err_log, omp_threads=None,
+                     itk_threads=None):
+    """
+    runs a python script as __main__ in this interpreter.  Modules imported
+    by the script stay loaded for later calls.  stdout and stderr are
+    redirected at the file descriptor level so that output of the script's
+    own subprocesses is logged too, and the thread counts are set in
+    os.environ for the duration of the call, hence this must not run
+    concurrently with anything else in this process.
+    :param cmd: script path followed by its arguments.
+    :param out_log: path to stdout log.
+    :param err_log: path to stderr log.
+    :param omp_threads: number of OpenMP and BLAS threads, see _thread_vars.
+    :param itk_threads: number of ITK threads, see _thread_vars.
+    :return: exit status, or None if the script could not be loaded, i.e.
+    it could not be read or compiled, or an import failed because this
+    interpreter lacks packages which the script's own interpreter has.
+    """
+    script = cmd[0]
+    try:
+        with open(script, 'rb') as fd:
+            code = compile(fd.read(), script, 'exec')
+    except (OSError, SyntaxError):
+        return None
+
+    argv, path = sys.argv, list(sys.path)
+    thread_vars = _thread_vars(omp_threads, itk_threads)
+    saved_env = {var: os.environ.get(var) for var in thread_vars}
+    os.environ.update(thread_vars)
+    sys.stdout.flush()
+    sys.stderr.flush()
+    saved_fds = os.dup(1), os.dup(2)
+    with open(out_log, 'w') as out, open(err_log, 'w') as err:
+        os.dup2(out.fileno(), 1)
+        os.dup2(err.fileno(), 2)
+        sys.argv = list(cmd)
+        sys.path.insert(0, os.path.dirname(script))
+        try:
+            exec(code, {'__name__': '__main__', '__file__': script})
+            result = 0
+        except SystemExit as e:
+            if e.code is None or isinstance(e.code, int):
+                result = e.code or 0
+            else:
+                print(e.code, file=sys.stderr)
+                result = 1
+        except ImportError:
+            # the caller reruns the script as a subprocess, which replaces
+            # the logs.
+            result = None
+        except Exception:
+            traceback.print_exc()
+            result = 1
+        finally:
+            sys.stdout.flush()
+            sys.stderr.flush()
+            os.dup2(saved_fds[0], 1)
+            os.dup2(saved_fds[1], 2)
+            os.close(saved_fds[0])
+            os.close(saved_fds[1])
+            sys.argv = argv
+            sys.path[:] = path
+            for var, value in saved_env.items():
+                if value is None:
+                    os.environ.pop(var, None)
+                else:
+                    os.environ[var] = value
+    return result
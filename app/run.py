@@ -27,13 +27,49 @@ Neuroinform. 2014 Apr 28;8:44. doi: 10.3389/fninf.2014.00044. eCollection 2014.
 __version__ = "1.0.1"
 
 import argparse
+import inspect
+import logging
+import multiprocessing
 import os
+import shlex
+import shutil
+import subprocess
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+from itertools import repeat
+from logging.handlers import QueueHandler, QueueListener
 
 from helpers import (read_bids_dataset, validate_config, validate_license)
 from pipelines import (ParameterSettings, PreFreeSurfer, FreeSurfer,
                        PostFreeSurfer, FMRIVolume, FMRISurface,
                        DCANBOLDProcessing, ExecutiveSummary, CustomClean,
-                       FileMapper)
+                       FileMapper, Stage)
+
+# names of all stages, in order of execution.
+STAGE_NAMES = ('PreFreeSurfer', 'FreeSurfer', 'PostFreeSurfer', 'FMRIVolume',
+               'FMRISurface', 'DCANBOLDProcessing', 'ExecutiveSummary',
+               'CustomClean', 'FileMapper')
+
+_log = logging.getLogger('dcan')
+# format of log records when sessions run in parallel, see _SessionFilter.
+_SESSION_FORMAT = '[sub-%(subject)s ses-%(session)s] %(message)s'
+
+
+class _SessionFilter(logging.Filter):
+    """
+    adds the subject and session being processed to log records.
+    """
+
+    def __init__(self, session):
+        super(__class__, self).__init__()
+        self.subject = session['subject']
+        self.session = session['session']
+
+    def filter(self, record):
+        record.subject = self.subject
+        record.session = self.session
+        return True
 
 
 def _cli():
@@ -44,45 +80,105 @@ def _cli():
     parser = generate_parser()
     args = parser.parse_args()
 
-    kwargs = {
-        'bids_dir': args.bids_dir,
-        'output_dir': args.output_dir,
-        'aseg': args.aseg,
-        'atropos_mask_method': args.atropos_mask_method,
-        'atropos_range': args.atropos_range,
-        'bandstop_params': args.bandstop,
-        'dcmethod': args.dcmethod,
-        'freesurfer_license': args.freesurfer_license,
-        'hyper_norm_method': args.hyper_norm_method,
-        'jlf_method': args.jlf_method,
-        'max_cortical_thickness': args.max_cortical_thickness,
-        'mc_frame': args.mc_frame,
-        'multi_masking_dir': args.multi_masking_dir,
-        'multi_template_dir': args.multi_template_dir,
-        'no_crop': args.no_crop,
-        'subject_list': args.subject_list,
-        'session_list': args.session_list,
-        'smoothing_iterations': args.smoothing_iterations,
-        'subcortical_map_method': args.subcortical_map_method,
-        't1_brain_mask': args.t1_brain_mask,
-        't1_study_template': args.t1_study_template,
-        't2_study_template': args.t2_study_template,
-        'anat_only': args.anat_only,
-        'cleaning_json': args.cleaning_json,
-        'file_mapper_json': args.file_mapper_json,
-        'check_only': args.check_outputs_only,
-        'ignore_expected_outputs': args.ignore_expected_outputs,
-        'ncpus': args.ncpus,
-        'print_commands': args.print_commands,
-        'stages': args.stages
-    }
+    # parser destinations which are named differently in interface.
+    rename = {'bandstop': 'bandstop_params',
+              'check_outputs_only': 'check_only'}
+    params = inspect.signature(interface).parameters
+    kwargs = {rename.get(k, k): v for k, v in vars(args).items()
+              if rename.get(k, k) in params}
+
+    if args.emit_sbatch:
+        subjects = [s for s in _list_subjects(args.bids_dir)
+                    if not args.subject_list or s in args.subject_list]
+        assert subjects, 'no subjects to run in %s.' % args.bids_dir
+        # each task is given its subject, so the selection of subjects is
+        # not passed on.
+        strip = ('--emit-sbatch', '--sbatch-command', '--participant-label')
+        argv = shlex.split(args.sbatch_command) if args.sbatch_command \
+            else [os.path.abspath(sys.argv[0])]
+        argv += _strip_options(sys.argv[1:], strip, parser)
+        print(_sbatch_script(argv, subjects, args.ncpus))
+        return
 
     return interface(**kwargs)
 
 
+def _strip_options(argv, strip, parser):
+    """
+    removes options and their values from a command line.
+    :param argv: command line arguments, without the program.
+    :param strip: option strings of the options to remove.
+    :param parser: parser of the command line, to resolve abbreviated
+    options and the number of values of each option as argparse does.
+    :return: remaining arguments.
+    """
+    actions = {o: action for action in parser._actions
+               for o in action.option_strings}
+    result = []
+    # number of values of a removed option still to skip.
+    skip = 0
+    for arg in argv:
+        if arg.startswith('-'):
+            name = arg.partition('=')[0]
+            if name not in actions and name.startswith('--'):
+                # argparse accepts unique prefixes of long options.
+                name = next((o for o in actions if o.startswith(name)), name)
+            skip = 0
+            if name in strip:
+                nargs = actions[name].nargs
+                # values given with "=" are part of the option itself.
+                if '=' not in arg and nargs != 0:
+                    skip = 1 if nargs in (None, '?') else \
+                        nargs if isinstance(nargs, int) else float('inf')
+                continue
+        elif skip:
+            skip -= 1
+            continue
+        result.append(arg)
+    return result
+
+
+def _list_subjects(bids_dir):
+    """
+    lists subjects by their folders, without indexing the dataset.
+    :param bids_dir: input bids dataset.
+    :return: sorted list of participant labels, without "sub-".
+    """
+    with os.scandir(bids_dir) as entries:
+        return sorted(e.name[4:] for e in entries
+                      if e.name.startswith('sub-') and e.is_dir())
+
+
+def _sbatch_script(argv, subjects, ncpus=1):
+    """
+    creates a slurm batch script running one subject per array task.
+    :param argv: command line to run in each task, without subjects.
+    :param subjects: participant labels, one per task.
+    :param ncpus: number of cores per task.
+    :return: contents of the batch script.
+    """
+    return '\n'.join([
+        '#!/bin/bash',
+        '#SBATCH --job-name=dcan-infant-pipeline',
+        '#SBATCH --array=1-%d' % len(subjects),
+        '#SBATCH --cpus-per-task=%d' % ncpus,
+        '#SBATCH --output=dcan-infant-pipeline_%A_%a.out',
+        '# add --time, --mem and --partition as required by your cluster.',
+        '',
+        '# participant labels, one per array task.',
+        'SUBJECTS=(%s)' % ' '.join(shlex.quote(s) for s in subjects),
+        '',
+        ' '.join(shlex.quote(a) for a in argv) +
+        ' --participant-label "${SUBJECTS[SLURM_ARRAY_TASK_ID - 1]}"',
+        ''
+    ])
+
+
+@lru_cache(maxsize=1)
 def generate_parser(parser=None):
     """
-    Generates the command line parser for this program.
+    Generates the command line parser for this program.  The parser is built
+    once and shared by later calls.
     :param parser: optional subparser for wrapping this program as a submodule.
     :return: ArgumentParser for this script/module
     """
@@ -312,11 +408,51 @@ def generate_parser(parser=None):
         description='Run-time instructions. These options are not passed to '
         'the stages. Rather, they control what and how the pipeline is run.'
     )
+    runopts.add_argument(
+        '--bids-database', metavar='FILE',
+        help='sqlite file in which to keep the index of the bids dataset '
+             'between runs, which saves indexing large datasets on every '
+             'run. Created if it does not exist. Delete it whenever the '
+             'dataset changes.'
+    )
+    runopts.add_argument(
+        '--bold-proc-in-process', action='store_true',
+        help='run the setup and teardown steps of DCANBOLDProcessing inside '
+             'this python interpreter instead of as subprocesses, to save '
+             'the startup and import time of dcan_bold_proc.py.'
+    )
     runopts.add_argument(
         '--check-outputs-only', action='store_true',
         help='checks for the existence of outputs for each stage then exit. '
              'Useful for debugging.'
     )
+    runopts.add_argument(
+        '--emit-sbatch', action='store_true',
+        help='print a slurm batch script which runs this command as a job '
+             'array with one subject per task, then exit. The subjects are '
+             'those given by --participant-label, or all subject folders, '
+             'and each task is passed its own --participant-label. See also '
+             '--sbatch-command.'
+    )
+    runopts.add_argument(
+        '--exec-last-stage', action='store_true',
+        help='replace this process with the last stage of the last session, '
+             'if it is ExecutiveSummary, CustomClean or FileMapper, to free '
+             'its memory while the stage runs. The exit code is that of the '
+             'stage, whose status and outputs are then not checked. '
+             'Requires --nsessions=1.'
+    )
+    runopts.add_argument(
+        '--executor', choices=['local', 'ray', 'dask'], default='local',
+        help='where to run the sessions. "local" runs them on this machine, '
+             'see --nsessions. "ray" runs each session as a task of the ray '
+             'cluster this node belongs to, and "dask" as a task of the '
+             'active dask.distributed client, or else as a process of '
+             'dask\'s multiprocessing scheduler, each with --ncpus cores. '
+             'Falls back to "local" if the package is not installed or no '
+             'ray cluster is running. Not compatible with --nsessions and '
+             '--exec-last-stage. Default: local.'
+    )
     runopts.add_argument(
         '--ignore-expected-outputs', action='store_true',
         help='continues pipeline even if some expected outputs are missing.'
@@ -329,10 +465,33 @@ def generate_parser(parser=None):
              'produce non-deterministic results. '
              'Default: 1.'
     )
+    runopts.add_argument(
+        '--nsessions', type=int,
+        default=1,
+        help='number of sessions to process in parallel, each in its own '
+             'process.  The sessions share the --ncpus cores evenly, and '
+             'their messages are prefixed with subject and session. '
+             'Default: 1.'
+    )
     runopts.add_argument(
         '--print-commands-only', action='store_true', dest='print_commands',
         help='print run commands for each stage to shell then exit.'
     )
+    runopts.add_argument(
+        '--sbatch-command', metavar='COMMAND',
+        help='with --emit-sbatch, the command which runs this pipeline on '
+             'the compute nodes, e.g. "singularity run --bind /data '
+             'infant-abcd-bids-pipeline.sif". Needed when this is run inside '
+             'a container. Default: the path of this script.'
+    )
+    runopts.add_argument(
+        '--scratch-dir', metavar='DIR',
+        help='fast local directory, e.g. on a node SSD or tmpfs, in which '
+             'to process each session. Earlier outputs of the session are '
+             'copied there first, and all outputs are copied back to the '
+             'output directory when the session ends. Not compatible with '
+             '--exec-last-stage.'
+    )
     runopts.add_argument(
         '--stage','--stages', dest='stages',
         metavar='STAGE',
@@ -363,7 +522,10 @@ def generate_parser(parser=None):
              'no --stage argument. '
              'Valid stage names: '
              'PreFreeSurfer, FreeSurfer, PostFreeSurfer, FMRIVolume, '
-             'FMRISurface, DCANBOLDProcessing, ExecutiveSummary '
+             'FMRISurface, DCANBOLDProcessing, ExecutiveSummary, '
+             'CustomClean (with --custom-clean), FileMapper (with '
+             '--file-mapper-json). The given stages must be run for each '
+             'session, e.g. not FMRIVolume with --anat-only.'
     )
     runopts.add_argument(
         '--version', '-v', action='version', version='%(prog)s ' + __version__
@@ -383,7 +545,9 @@ def interface(bids_dir, output_dir, subject_list=None, session_list=None,
               t1_study_template=None, t2_study_template=None,
               anat_only=False, cleaning_json=None, file_mapper_json=None,
               check_only=False, ignore_expected_outputs=False, ncpus=1,
-              print_commands=False, stages=None):
+              print_commands=False, stages=None, bold_proc_in_process=False,
+              exec_last_stage=False, nsessions=1, bids_database=None,
+              scratch_dir=None, executor='local'):
     """
     main application interface
     :param bids_dir: input bids dataset see "helpers.read_bids_dataset" for more info.
@@ -416,8 +580,34 @@ def interface(bids_dir, output_dir, subject_list=None, session_list=None,
     :param ncpus: number of cores for parallelized processing.
     :param print_commands: print commands but don't execute them.
     :param stages: only run a subset of stages.
+    :param bold_proc_in_process: run DCANBOLDProcessing setup and teardown in
+    this interpreter.
+    :param exec_last_stage: replace the process with the last stage of the
+    last session.
+    :param nsessions: number of sessions to process in parallel, sharing
+    ncpus.
+    :param bids_database: path to a persistent index of the bids dataset.
+    :param scratch_dir: local directory in which to process each session.
+    :param executor: "local", "ray" or "dask", see _run_distributed.
     :return:
     """
+    # arguments for each session, see _run_session.
+    kwargs = dict(locals())
+    kwargs['stage_names'] = _parse_stages(stages)
+    _log_to_stdout()
+    # in process calls redirect the output and environment of the whole
+    # process, see pipelines._call_in_process.
+    assert not bold_proc_in_process or (nsessions == 1 and
+                                        executor == 'local'), \
+        '--bold-proc-in-process requires --nsessions=1 and --executor=local'
+    assert not exec_last_stage or nsessions == 1, \
+        '--exec-last-stage requires --nsessions=1'
+    assert executor == 'local' or not (nsessions > 1 or exec_last_stage), \
+        '--nsessions and --exec-last-stage require --executor=local'
+    # the outputs in scratch space are copied back after the last stage,
+    # which cannot happen once it has replaced the process.
+    assert not (exec_last_stage and scratch_dir), \
+        '--exec-last-stage cannot be used with --scratch-dir'
     if not check_only and not print_commands:
         validate_license(freesurfer_license)
     # Read from bids dataset.
@@ -425,161 +615,312 @@ def interface(bids_dir, output_dir, subject_list=None, session_list=None,
     if not os.path.isdir(output_dir):
         os.makedirs(output_dir)
     session_generator = read_bids_dataset(
-        bids_dir, subject_list=subject_list, session_list=session_list)
+        bids_dir, subject_list=subject_list, session_list=session_list,
+        database_file=bids_database)
+
+    if executor != 'local':
+        if _run_distributed(executor, session_generator, kwargs):
+            return
+        _log.warning('%s is not available, running sessions locally.' %
+                     executor)
+
+    if nsessions > 1:
+        # share the cores between sessions rather than oversubscribe them.
+        kwargs['ncpus'] = max(1, ncpus // nsessions)
+        # Run sessions in parallel, each in its own process.  Each session
+        # is submitted as soon as it is read, while the next is read.  The
+        # sessions send their log records to a listener in this process, so
+        # that the lines of different sessions are not interleaved.
+        with multiprocessing.Manager() as manager:
+            log_queue = manager.Queue()
+            listener = QueueListener(log_queue, *_log.handlers)
+            listener.start()
+            try:
+                with ProcessPoolExecutor(max_workers=nsessions) as pool:
+                    # consume the results to raise errors from any session.
+                    list(pool.map(_run_session, session_generator,
+                                  repeat(kwargs), repeat(False),
+                                  repeat(log_queue)))
+            finally:
+                listener.stop()
+    else:
+        if exec_last_stage:
+            # the last session must be known before running its last stage.
+            session_generator = list(session_generator)
+        # Run each session in serial.
+        for session in session_generator:
+            terminal = exec_last_stage and session is session_generator[-1]
+            _run_session(session, kwargs, terminal=terminal)
+
+
+def _log_to_stdout():
+    """
+    writes progress messages to stdout, unless the logger is already set up.
+    :return: None
+    """
+    if not _log.handlers:
+        handler = logging.StreamHandler(sys.stdout)
+        handler.setFormatter(logging.Formatter('%(message)s'))
+        _log.addHandler(handler)
+        _log.setLevel(logging.INFO)
+        _log.propagate = False
+
 
-    # Run each session in serial.
-    for session in session_generator:
-        # Setup session configuration.
-        out_dir = os.path.join(
-            output_dir,
+def _run_distributed(executor, sessions, kwargs):
+    """
+    runs each session as a task of a ray or dask cluster, which may span
+    many nodes.
+    :param executor: "ray" or "dask".
+    :param sessions: iterable of bids data of each session.
+    :param kwargs: arguments to interface.
+    :return: False if the executor is not installed or, for ray, no cluster
+    is running, else True.
+    """
+    if executor == 'ray':
+        try:
+            import ray
+            ray.init(address='auto')
+        except (ImportError, ConnectionError):
+            return False
+        run_session = ray.remote(num_cpus=kwargs['ncpus'])(_run_session)
+        ray.get([run_session.remote(s, kwargs) for s in sessions])
+    else:
+        try:
+            import dask
+        except ImportError:
+            return False
+        # sessions change process wide state, e.g. the class flags of the
+        # stages, so each needs its own process rather than a thread of the
+        # default scheduler.  Without a distributed client, run as many
+        # sessions at once as the cores allow.
+        try:
+            from distributed import default_client
+            default_client()
+            options = {}
+        except (ImportError, ValueError):
+            workers = max(1, (os.cpu_count() or 1) // kwargs['ncpus'])
+            options = {'scheduler': 'processes', 'num_workers': workers}
+        dask.compute(*[dask.delayed(_run_session)(s, kwargs)
+                       for s in sessions], **options)
+    return True
+
+
+def _parse_stages(stages=None):
+    """
+    parses the stages argument.  User can indicate start or end or both;
+    default to all stages.
+    :param stages: start and end stage names separated by a colon.  No
+    colon means no end stage.
+    :return: start and end stage names, None where not given.
+    """
+    start_stage, _, end_stage = (stages or '').partition(':')
+    for stage_name in (start_stage, end_stage):
+        assert not stage_name or stage_name in STAGE_NAMES, \
+                '"%s" is unknown, check class name and case for given stage' \
+                % stage_name
+    return start_stage or None, end_stage or None
+
+
+def _rsync(src, dst):
+    """
+    copies the contents of directory src into directory dst.
+    :param src: source directory.
+    :param dst: destination directory, created if missing.
+    :return: None
+    """
+    os.makedirs(dst, exist_ok=True)
+    subprocess.run(['rsync', '-a', src + '/', dst + '/'], check=True)
+
+
+def _run_session(session, kwargs, terminal=False, log_queue=None):
+    """
+    runs the pipeline for one session.  Sessions are independent, so this
+    may run in a separate process per session.
+    :param session: bids data of the session, see helpers.read_bids_dataset.
+    :param kwargs: arguments to interface.
+    :param terminal: nothing runs after this session, so its last stage may
+    replace the process.  See Stage.exec_replace.
+    :param log_queue: queue to the log listener of the parent process, if
+    run in a separate process.
+    :return: None
+    """
+    if log_queue is not None:
+        _log.handlers = [QueueHandler(log_queue)]
+        _log.setLevel(logging.INFO)
+        _log.propagate = False
+    else:
+        # e.g. a fresh ray or dask worker.
+        _log_to_stdout()
+    # tag records with this session, so that records of parallel sessions
+    # can be told apart.
+    for log_filter in list(_log.filters):
+        if isinstance(log_filter, _SessionFilter):
+            _log.removeFilter(log_filter)
+    _log.addFilter(_SessionFilter(session))
+    if kwargs['nsessions'] > 1 or kwargs['executor'] != 'local':
+        for handler in _log.handlers:
+            handler.setFormatter(logging.Formatter(_SESSION_FORMAT))
+    if kwargs['bold_proc_in_process']:
+        DCANBOLDProcessing.activate_in_process()
+
+    # Setup session configuration.
+    out_dir = os.path.join(
+        kwargs['output_dir'],
+        'sub-%s' % session['subject'],
+        'ses-%s' % session['session']
+    )
+
+    if kwargs['scratch_dir'] and not (kwargs['check_only'] or
+                                      kwargs['print_commands']):
+        # process the session in scratch space, starting from any earlier
+        # outputs, then copy everything back.
+        work_dir = os.path.join(
+            kwargs['scratch_dir'],
             'sub-%s' % session['subject'],
             'ses-%s' % session['session']
         )
-
-        # detect available data for pipeline stages
-        validate_config(session, anat_only)
-        modes = session['types']
-        run_anat = 'T1w' in modes
-        run_func = 'bold' in modes and not anat_only
-        run_summary = True
-
-        # Set user input parameters for this session, before initializing
-        # each stage with the session specification (below).
-        session_spec = ParameterSettings(session, out_dir)
-
-        session_spec.set_anat_only(anat_only)
-
-        if aseg is not None:
-            session_spec.set_aseg(aseg)
-
-        if atropos_mask_method is not None:
-            session_spec.set_atropos_mask_method(atropos_mask_method)
-
-        if atropos_range is not None:
-            session_spec.set_atropos_range(*atropos_range)
-
-        if bandstop_params is not None:
-            session_spec.set_bandstop_filter(*bandstop_params)
-
-        if dcmethod is not None:
-            session_spec.set_dcmethod(dcmethod)
-
-        if hyper_norm_method is None:
-            # Default is ADULT_GM_IP.
-            session_spec.set_hypernormalization_method("ADULT_GM_IP")
-        else:
-            session_spec.set_hypernormalization_method(hyper_norm_method)
-
-        if jlf_method is not None:
-            session_spec.set_jlf_method(jlf_method)
-
-        if max_cortical_thickness is not 5:
-            session_spec.set_max_cortical_thickness(max_cortical_thickness)
-
-        session_spec.set_smoothing_iterations(smoothing_iterations)
-
-        if subcortical_map_method is not None:
-            session_spec.set_subcortical_map_method(subcortical_map_method)
-
-        if t1_brain_mask is not None:
-            session_spec.set_t1_brain_mask(t1_brain_mask)
-
-        session_spec.set_templates(*t1_study_template, *t2_study_template,
-                multi_template_dir, multi_masking_dir)
-
-        if no_crop:
-            session_spec.turn_off_cropping()
-
-        if mc_frame is not None:
-            session_spec.set_mc_frame(mc_frame)
-
-        # create pipelines
-        order = []
-
-        # Create pipeline.
-        if run_anat:
-            pre = PreFreeSurfer(session_spec)
-            free = FreeSurfer(session_spec)
-            post = PostFreeSurfer(session_spec)
-            order += [pre, free, post]
-        if run_func:
-            vol = FMRIVolume(session_spec)
-            surf = FMRISurface(session_spec)
-            boldproc = DCANBOLDProcessing(session_spec)
-            order += [vol, surf, boldproc]
-        if run_summary:
-            execsum = ExecutiveSummary(session_spec)
-            order += [execsum]
-
-        # Add optional pipeline stages
-        if cleaning_json:
-            cclean = CustomClean(session_spec, cleaning_json)
-            order.append(cclean)
-
-        if file_mapper_json:
-            fmap = FileMapper(session_spec, file_mapper_json)
-            order.append(fmap)
-
-        # Special runtime options
-        if stages:
-            # User can indicate start or end or both; default
-            # to entire list built above.
-            start_idx = 0
-            end_idx = len(order)
-
-            idx_colon = stages.find(":")
-            if idx_colon > -1:
-                # Start stage is everything before the colon.
-                start_stage = stages[:idx_colon]
-                # End stage is everything after the colon.
-                end_stage = stages[(idx_colon+1):]
-            else:
-                # No colon means no end stage.
-                start_stage = stages
-                end_stage = None
-
-            names = [x.__class__.__name__ for x in order]
-
-            if start_stage:
-                assert start_stage in names, \
-                        '"%s" is unknown, check class name and case for given stage' \
-                        % start_stage
-                start_idx = names.index(start_stage)
-
-            if end_stage is not None:
-                assert end_stage in names, \
-                        '"%s" is unknown, check class name and case for given stage' \
-                        % end_stage
-                end_idx = names.index(end_stage)
-                end_idx += 1 # Include end stage.
-
-            # Slice the list.
-            order = order[start_idx:end_idx]
-
-        if check_only:
-            for stage in order:
-                print('checking outputs for %s' % stage.__class__.__name__, flush=True)
-                try:
-                    stage.check_expected_outputs()
-                except AssertionError:
-                    pass
-            return
-        if print_commands:
-            for stage in order:
-                stage.deactivate_runtime_calls()
-                stage.deactivate_check_expected_outputs()
-                stage.deactivate_remove_expected_outputs()
-        if ignore_expected_outputs:
-            print('ignoring checks for expected outputs.', flush=True)
-            for stage in order:
-                stage.activate_ignore_expected_outputs()
-
-        # run pipelines
+        if os.path.isdir(out_dir):
+            _rsync(out_dir, work_dir)
+        try:
+            _run_session(session, dict(kwargs, output_dir=kwargs['scratch_dir'],
+                                       scratch_dir=None))
+        finally:
+            if os.path.isdir(work_dir):
+                _rsync(work_dir, out_dir)
+                # only reached once the outputs are copied back.
+                shutil.rmtree(work_dir)
+            try:
+                os.rmdir(os.path.dirname(work_dir))
+            except OSError:
+                pass  # other sessions of the subject still use it.
+        return
+
+    # detect available data for pipeline stages
+    validate_config(session, kwargs['anat_only'])
+    modes = session['types']
+    run_anat = 'T1w' in modes
+    run_func = 'bold' in modes and not kwargs['anat_only']
+    run_summary = True
+
+    # Set user input parameters for this session, before initializing
+    # each stage with the session specification (below).
+    session_spec = ParameterSettings(session, out_dir)
+
+    session_spec.set_anat_only(kwargs['anat_only'])
+
+    if kwargs['aseg'] is not None:
+        session_spec.set_aseg(kwargs['aseg'])
+
+    if kwargs['atropos_mask_method'] is not None:
+        session_spec.set_atropos_mask_method(kwargs['atropos_mask_method'])
+
+    if kwargs['atropos_range'] is not None:
+        session_spec.set_atropos_range(*kwargs['atropos_range'])
+
+    if kwargs['bandstop_params'] is not None:
+        session_spec.set_bandstop_filter(*kwargs['bandstop_params'])
+
+    if kwargs['dcmethod'] is not None:
+        session_spec.set_dcmethod(kwargs['dcmethod'])
+
+    if kwargs['hyper_norm_method'] is None:
+        # Default is ADULT_GM_IP.
+        session_spec.set_hypernormalization_method("ADULT_GM_IP")
+    else:
+        session_spec.set_hypernormalization_method(
+            kwargs['hyper_norm_method'])
+
+    if kwargs['jlf_method'] is not None:
+        session_spec.set_jlf_method(kwargs['jlf_method'])
+
+    if kwargs['max_cortical_thickness'] != 5:
+        session_spec.set_max_cortical_thickness(
+            kwargs['max_cortical_thickness'])
+
+    session_spec.set_smoothing_iterations(kwargs['smoothing_iterations'])
+
+    if kwargs['subcortical_map_method'] is not None:
+        session_spec.set_subcortical_map_method(
+            kwargs['subcortical_map_method'])
+
+    if kwargs['t1_brain_mask'] is not None:
+        session_spec.set_t1_brain_mask(kwargs['t1_brain_mask'])
+
+    session_spec.set_templates(
+            *kwargs['t1_study_template'], *kwargs['t2_study_template'],
+            kwargs['multi_template_dir'], kwargs['multi_masking_dir'])
+
+    if kwargs['no_crop']:
+        session_spec.turn_off_cropping()
+
+    if kwargs['mc_frame'] not in (None, 17):
+        session_spec.set_mc_frame(kwargs['mc_frame'])
+
+    # create pipelines: stage classes with their extra arguments, which are
+    # only instantiated for the stages to run.
+    order = []
+
+    # Create pipeline.
+    if run_anat:
+        order += [(PreFreeSurfer,), (FreeSurfer,), (PostFreeSurfer,)]
+    if run_func:
+        order += [(FMRIVolume,), (FMRISurface,), (DCANBOLDProcessing,)]
+    if run_summary:
+        order += [(ExecutiveSummary,)]
+
+    # Add optional pipeline stages
+    if kwargs['cleaning_json']:
+        order.append((CustomClean, kwargs['cleaning_json']))
+
+    if kwargs['file_mapper_json']:
+        order.append((FileMapper, kwargs['file_mapper_json']))
+
+    # Special runtime options
+    start_stage, end_stage = kwargs['stage_names']
+    names = [x[0].__name__ for x in order]
+    for stage_name in (start_stage, end_stage):
+        if stage_name and stage_name not in names:
+            raise ValueError(
+                '"%s" is not run for subject %s session %s, check the data '
+                'and options for this session' % (
+                    stage_name, session['subject'], session['session']))
+    start_idx = names.index(start_stage) if start_stage else 0
+    # Include end stage.
+    end_idx = names.index(end_stage) + 1 if end_stage else len(names)
+    order = order[start_idx:end_idx]
+
+    order = [stage_class(session_spec, *args) for stage_class, *args in order]
+
+    if kwargs['check_only']:
+        # list the output directories of all stages at once, then report in
+        # order.
+        contents = Stage.list_output_dirs(order)
+        found = [stage.find_expected_outputs(contents) for stage in order]
+        for stage, stage_found in zip(order, found):
+            _log.info('checking outputs for %s' % stage.__class__.__name__)
+            try:
+                stage.check_expected_outputs(stage_found)
+            except AssertionError:
+                pass
+        return
+    if kwargs['print_commands']:
         for stage in order:
-            print('running %s' % stage.__class__.__name__, flush=True)
-            print(stage, flush=True)
-            stage.run(ncpus)
-
+            stage.deactivate_runtime_calls()
+            stage.deactivate_check_expected_outputs()
+            stage.deactivate_remove_expected_outputs()
+    if kwargs['ignore_expected_outputs']:
+        _log.info('ignoring checks for expected outputs.')
+        for stage in order:
+            stage.activate_ignore_expected_outputs()
+
+    # run pipelines
+    for stage in order:
+        _log.info('running %s' % stage.__class__.__name__)
+        # printed commands are meant to be rerun in a shell, but a run
+        # logs what it actually runs.
+        _log.info(stage.format_commands(
+            resolve_env=not kwargs['print_commands']))
+        stage.run(kwargs['ncpus'], terminal=terminal and stage is order[-1])
 
 if __name__ == '__main__':
     _cli()
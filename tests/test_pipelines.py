@@ -0,0 +1,50 @@
+import os
+import sys
+import unittest
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir, 'app'))
+
+import pipelines
+
+
+class IntendedSefmapsTest(unittest.TestCase):
+
+    fmri = '/bids/sub-01/ses-A/func/sub-01_ses-A_task-rest_run-02_bold.nii.gz'
+
+    def _stage(self, intended_for):
+        # only the attributes used by FMRIVolume._get_intended_sefmaps.
+        fmap = {'positive': ['/p1.nii.gz', '/p2.nii.gz'],
+                'negative': ['/n1.nii.gz', '/n2.nii.gz']}
+        metadata = {direction: [{}, {'IntendedFor': intended_for}]
+                    for direction in fmap}
+        relpath = 'ses-A/func/sub-01_ses-A_task-rest_run-02_bold.nii.gz'
+        config = SimpleNamespace(
+            func_index={self.fmri: {'relpath': relpath}},
+            get_bids=lambda key, direction, idx: fmap[direction][idx])
+        return SimpleNamespace(config=config, _sefm_metadata=metadata)
+
+    def _sefmaps(self, intended_for):
+        return pipelines.FMRIVolume._get_intended_sefmaps(
+            self._stage(intended_for), self.fmri)
+
+    def test_relative_to_subject(self):
+        self.assertEqual(
+            self._sefmaps(['ses-A/func/sub-01_ses-A_task-rest_run-02_bold.nii.gz']),
+            ('/p2.nii.gz', '/n2.nii.gz'))
+
+    def test_bids_uri(self):
+        self.assertEqual(
+            self._sefmaps('bids::sub-01/ses-A/func/'
+                          'sub-01_ses-A_task-rest_run-02_bold.nii.gz'),
+            ('/p2.nii.gz', '/n2.nii.gz'))
+
+    def test_other_run_is_not_matched(self):
+        self.assertEqual(
+            self._sefmaps(['bids::sub-01/ses-A/func/'
+                           'sub-01_ses-A_task-rest_run-12_bold.nii.gz']),
+            ('/p1.nii.gz', '/n1.nii.gz'))
+
+
+if __name__ == '__main__':
+    unittest.main()
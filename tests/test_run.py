@@ -0,0 +1,54 @@
+import contextlib
+import io
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir, 'app'))
+
+import run
+
+
+class EmitSbatchTest(unittest.TestCase):
+
+    def setUp(self):
+        self.bids_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.bids_dir)
+        for subject in ('01', '02', '03'):
+            os.mkdir(os.path.join(self.bids_dir, 'sub-' + subject))
+
+    def _emit(self, *args):
+        stdout = io.StringIO()
+        argv = ['/app/run.py'] + list(args)
+        with mock.patch.object(sys, 'argv', argv), \
+                contextlib.redirect_stdout(stdout):
+            run._cli()
+        # the command is the last line of the script.
+        return stdout.getvalue().strip().splitlines()
+
+    def test_positionals_after_flag(self):
+        script = self._emit('--emit-sbatch', self.bids_dir, '/data/out',
+                            '--ncpus', '2')
+        self.assertIn('#SBATCH --array=1-3', script)
+        self.assertEqual(
+            script[-1],
+            '/app/run.py %s /data/out --ncpus 2 --participant-label '
+            '"${SUBJECTS[SLURM_ARRAY_TASK_ID - 1]}"' % self.bids_dir)
+
+    def test_participant_labels(self):
+        script = self._emit(self.bids_dir, '/data/out', '--participant-label',
+                            '01', '03', '--emit-sbatch', '--sbatch-command',
+                            'singularity run pipeline.sif')
+        self.assertIn('#SBATCH --array=1-2', script)
+        self.assertIn('SUBJECTS=(01 03)', script)
+        self.assertEqual(
+            script[-1],
+            'singularity run pipeline.sif %s /data/out --participant-label '
+            '"${SUBJECTS[SLURM_ARRAY_TASK_ID - 1]}"' % self.bids_dir)
+
+
+if __name__ == '__main__':
+    unittest.main()